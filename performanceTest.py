@@ -40,21 +40,41 @@ def standardBig(count):
     toc = time.time()
     print "took %fsec" % (toc - tic)
 
-def redishBig(count):
-    print "Writing to %u keys with SET using redish ..." % count,
+def redishBig(count, workers=0):
+    print "Writing to %u keys with SET using redish with %u codec workers ..." % (count, workers),
     stdin = '{"command": "CONNECT"}\n'
     for i in range(count):
         stdin += '{"id": 1, "command": "SET", "args":["hi%u", %u]}\n' % (i, i)
     stdin += '{"id": 1, "command": "GET", "args":["hi%u"]}\n' % i
     tic = time.time()
-    proc = subprocess.Popen(["python", "redish.py", "%u" % count], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    proc = subprocess.Popen(["python", "redish.py", "%u" % count, "--codec-workers", "%u" % workers], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
     stdout, stderr = proc.communicate(stdin)
     toc = time.time()
     print "took %fsec" % (toc - tic)
 
-count = 100000
-standard(count)
-redish(count)
-standardBig(count)
-redishBig(count)
+def replayTrace(path, maxKeys):
+    print "Replaying trace %s with redish ..." % path,
+    sys.stdout.flush()
+    with open(path) as traceFile:
+        stdin = traceFile.read()
+    tic = time.time()
+    proc = subprocess.Popen(["python", "redish.py", maxKeys], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    stdout, stderr = proc.communicate(stdin)
+    toc = time.time()
+    print "took %fsec" % (toc - tic)
+
+if len(sys.argv) > 1:
+    # python performanceTest.py <trace file> [maxkeys]
+    maxKeys = "100000"
+    if len(sys.argv) > 2:
+        maxKeys = sys.argv[2]
+    replayTrace(sys.argv[1], maxKeys)
+else:
+    count = 100000
+    standard(count)
+    redish(count)
+    standardBig(count)
+    redishBig(count)
+    redishBig(count, 2)
+    redishBig(count, 4)
 
@@ -2,10 +2,267 @@ import sys
 import json
 import collections
 import argparse
+import bisect
+import itertools
+import mmap
+import multiprocessing
+import threading
+import Queue
+import os
+import time
+import cProfile
+import pstats
+
+EVICTION_MODES = ("INLINE", "COUNT", "NONE")
+
+# Commands which are not profiled or traced themselves
+ADMIN_COMMANDS = ("PROFILE", "TRACE")
+
+# CPROFILE is expensive, so it always runs for a bounded window
+CPROFILE_DEFAULT_SECONDS = 10
+
+# What the database holds in place of a value that lives in the arena
+ArenaValue = collections.namedtuple("ArenaValue", ["offset", "length", "isUnicode"])
+
+class ValueArena():
+    # Stores large string values in a memory mapped file instead of the heap.
+    # Free space is kept as a sorted list of blocks, coalesced on free.
+    def __init__(self, path, threshold, initialSize=1 << 20):
+        self.threshold = threshold
+        self.file = open(path, "w+b")
+        self.file.truncate(initialSize)
+        self.size = initialSize
+        self.map = mmap.mmap(self.file.fileno(), initialSize)
+        # Everything past end has never been handed out
+        self.end = 0
+        self.freeOffsets = []
+        self.freeLengths = []
+
+    def _allocate(self, length):
+        # First fit from the free list. This is a linear scan over the free
+        # blocks, so allocation slows down as the arena fragments.
+        for i in range(len(self.freeOffsets)):
+            if self.freeLengths[i] >= length:
+                offset = self.freeOffsets[i]
+                if self.freeLengths[i] == length:
+                    del self.freeOffsets[i]
+                    del self.freeLengths[i]
+                else:
+                    self.freeOffsets[i] += length
+                    self.freeLengths[i] -= length
+                return offset
+        # Nothing fits, so take from the end, growing the file if needed
+        if self.end + length > self.size:
+            newSize = max(self.size * 2, self.end + length)
+            # mmap.resize needs mremap, which not every platform has, so
+            # grow the file and map it again instead
+            self.map.close()
+            self.file.truncate(newSize)
+            self.map = mmap.mmap(self.file.fileno(), newSize)
+            self.size = newSize
+        offset = self.end
+        self.end += length
+        return offset
+
+    def store(self, value):
+        isUnicode = type(value) is unicode
+        if isUnicode:
+            value = value.encode("utf-8")
+        length = len(value)
+        offset = self._allocate(length)
+        self.map[offset:offset+length] = value
+        return ArenaValue(offset, length, isUnicode)
+
+    def load(self, ref):
+        value = self.map[ref.offset:ref.offset+ref.length]
+        if ref.isUnicode:
+            return value.decode("utf-8")
+        return value
+
+    def free(self, ref):
+        offset = ref.offset
+        length = ref.length
+        i = bisect.bisect(self.freeOffsets, offset)
+        # Merge with the following free block
+        if i < len(self.freeOffsets) and self.freeOffsets[i] == offset + length:
+            length += self.freeLengths[i]
+            del self.freeOffsets[i]
+            del self.freeLengths[i]
+        # Merge with the preceding free block
+        if i > 0 and self.freeOffsets[i-1] + self.freeLengths[i-1] == offset:
+            i -= 1
+            offset = self.freeOffsets[i]
+            length += self.freeLengths[i]
+            del self.freeOffsets[i]
+            del self.freeLengths[i]
+        if offset + length == self.end:
+            # Block is at the end, so just give it back
+            self.end = offset
+        else:
+            self.freeOffsets.insert(i, offset)
+            self.freeLengths.insert(i, length)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+_moduleNamesForFile = {}
+
+def _functionLabel(filename, name):
+    # Names functions in this module plainly, and others as module.function
+    if filename not in _moduleNamesForFile:
+        _moduleNamesForFile[filename] = None
+        source = os.path.splitext(os.path.abspath(filename))[0]
+        for module in sys.modules.values():
+            moduleFile = getattr(module, "__file__", None)
+            if moduleFile and os.path.splitext(os.path.abspath(moduleFile))[0] == source:
+                _moduleNamesForFile[filename] = module.__name__
+                break
+    module = _moduleNamesForFile[filename]
+    if module is None or module in ("__main__", __name__):
+        return name
+    return "%s.%s" % (module, name)
+
+class RequestProfiler():
+    def __init__(self, path, deadline):
+        self.file = open(path, "w")
+        # None means run until stopped
+        self.deadline = deadline
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def _writeReport(self, mode, commands):
+        json.dump({"mode": mode, "commands": commands}, self.file,
+                  indent=2, sort_keys=True)
+        self.file.close()
+
+class SamplingProfiler(RequestProfiler):
+    # Periodically looks at the stack of the thread running requests and
+    # counts, per command, how many samples each function was on the stack
+    def __init__(self, path, deadline, interval=0.001):
+        RequestProfiler.__init__(self, path, deadline)
+        self.interval = interval
+        self.command = None
+        self.samples = collections.Counter()
+        self.functionSamples = collections.defaultdict(collections.Counter)
+        self.threadID = threading.current_thread().ident
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _sample(self):
+        runCode = SamplingProfiler.run.__func__.__code__
+        while not self.stopped.wait(self.interval):
+            if self.expired():
+                # Write the report as soon as the window closes, not when
+                # the next request happens to arrive
+                self._finish()
+                return
+            command = self.command
+            frame = sys._current_frames().get(self.threadID)
+            if command is None:
+                # Idle, waiting for a request
+                continue
+            labels = set()
+            while frame is not None and frame.f_code is not runCode:
+                labels.add(_functionLabel(frame.f_code.co_filename, frame.f_code.co_name))
+                frame = frame.f_back
+            if frame is None:
+                # The request finished while we were looking
+                continue
+            self.samples[command] += 1
+            self.functionSamples[command].update(labels)
+
+    def run(self, command, func, request):
+        self.command = command
+        try:
+            return func(request)
+        finally:
+            self.command = None
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self._finish()
+
+    def _finish(self):
+        if self.file.closed:
+            # Already written when the window closed
+            return
+        commands = {}
+        for command, samples in self.samples.items():
+            commands[command] = {"samples": samples,
+                                 "functions": dict(self.functionSamples[command])}
+        self._writeReport("SAMPLE", commands)
+
+class DeterministicProfiler(RequestProfiler):
+    # Runs every request under cProfile, with one profile per command
+    def __init__(self, path, deadline):
+        RequestProfiler.__init__(self, path, deadline)
+        self.profiles = {}
+
+    def run(self, command, func, request):
+        if command not in self.profiles:
+            self.profiles[command] = cProfile.Profile()
+        return self.profiles[command].runcall(func, request)
+
+    def stop(self):
+        commands = {}
+        for command, profile in self.profiles.items():
+            functions = {}
+            stats = pstats.Stats(profile).stats
+            for (filename, line, name), (_, calls, totalTime, cumulativeTime, _) in stats.items():
+                label = _functionLabel(filename, name)
+                entry = functions.setdefault(
+                        label, {"calls": 0, "totalTime": 0.0, "cumulativeTime": 0.0})
+                entry["calls"] += calls
+                entry["totalTime"] += totalTime
+                entry["cumulativeTime"] += cumulativeTime
+            commands[command] = {"functions": functions}
+        self._writeReport("CPROFILE", commands)
+
+PROFILERS = {"SAMPLE": SamplingProfiler, "CPROFILE": DeterministicProfiler}
+
+class RequestTracer():
+    # Records requests, one json object per line, so they can be replayed
+    # by feeding the file to redish on stdin
+    def __init__(self, path, deadline, preamble):
+        self.file = open(path, "w")
+        self.deadline = deadline
+        # Guards file, which the timer closes from its own thread
+        self.lock = threading.Lock()
+        for request in preamble:
+            self.record(request)
+        self.timer = None
+        if deadline is not None:
+            # Finish the file when the window closes, not when the next
+            # request happens to arrive
+            self.timer = threading.Timer(max(0, deadline - time.time()), self.stop)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def record(self, request):
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(json.dumps(request) + "\n")
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        with self.lock:
+            self.file.close()
 
 class Redish():
-    def __init__(self, maxKeys):
+    def __init__(self, maxKeys, arena=None):
         self.database = collections.OrderedDict()
+        self.arena = arena
+        self.profiler = None
+        self.tracer = None
         self.conectionIDs = set()
         self.nextConnectionID = 1
         self.maxKeys = maxKeys
@@ -13,8 +270,15 @@ class Redish():
         self.connectionsWithTransactionInputErrors = set()
         self.watchedKeysForConnectionID = collections.defaultdict(set)
         self.connectionIDsWithWatchViolations = set()
+        self.evictionModeForConnectionID = {}
+        self.evictionSubscribers = set()
+        self.pendingNotifications = []
+        self.notificationBatchSize = 1000
+
+    def _set(self, key, value, request, loadEvicted=True):
+        # Without loadEvicted, None is returned in place of the evicted value,
+        # which saves copying it out of the arena when nobody will see it
 
-    def _set(self, key, value, request):
         # Need to identify if this database write is being watched
         connectionID = request["id"]
         if key in self.watchedKeysForConnectionID[connectionID]:
@@ -23,12 +287,16 @@ class Redish():
         # Then move on with the writing
         if key in self.database:
             # We need to delete to maintain the LRU order
-            del self.database[key]
-        self.database[key] = value
+            self._freeValue(self.database.pop(key))
+        self.database[key] = self._storeValue(value)
         if len(self.database) > self.maxKeys:
             # Get the oldest item
             key, value = self.database.popitem(False)
-            return [key, value]
+            evictedValue = None
+            if loadEvicted:
+                evictedValue = self._loadValue(value)
+            self._freeValue(value)
+            return [key, evictedValue]
         return []
 
     def _get(self, key):
@@ -38,8 +306,58 @@ class Redish():
             # Need to evict key and re add to update the LRU
             del self.database[key]
             self.database[key] = value
+        return self._loadValue(value)
+
+    def _storeValue(self, value):
+        # Large strings go to the arena, everything else stays in the database
+        if (self.arena is not None and isinstance(value, basestring)
+                and len(value) > self.arena.threshold):
+            return self.arena.store(value)
+        return value
+
+    def _loadValue(self, value):
+        if type(value) is ArenaValue:
+            return self.arena.load(value)
         return value
 
+    def _freeValue(self, value):
+        if type(value) is ArenaValue:
+            self.arena.free(value)
+
+    def _evictionMode(self, request):
+        return self.evictionModeForConnectionID.get(request["id"], "INLINE")
+
+    def _collectEvictions(self, request):
+        # Evicted pairs are only needed if the reply or a subscriber gets them
+        return (self._evictionMode(request) == "INLINE"
+                or len(self.evictionSubscribers) > 0)
+
+    def _reportEvictions(self, request, response, evicted, count):
+        # evicted holds key/value pairs flattened, count is the number of pairs.
+        # evicted is empty when _collectEvictions said not to bother.
+        if count == 0:
+            return
+        mode = self._evictionMode(request)
+        if mode == "INLINE":
+            response["evicted"] = evicted
+        elif mode == "COUNT":
+            response["evictedCount"] = count
+        # Subscribers get every eviction, whatever the writer asked for.
+        # Split into batches so a huge MSET doesn't produce one huge line.
+        batchLen = self.notificationBatchSize * 2
+        for subscriber in sorted(self.evictionSubscribers):
+            for i in range(0, len(evicted), batchLen):
+                self.pendingNotifications.append(
+                        {"notification": "EVICTED",
+                         "id": subscriber,
+                         "evicted": evicted[i:i+batchLen]})
+
+    def drainNotifications(self):
+        # Notifications are sent out of band, after the reply that caused them
+        notifications = self.pendingNotifications
+        self.pendingNotifications = []
+        return notifications
+
     def _enqueueRequest(self, request):
         # Detect if we're in a MULTI block and enqueue instead of executing
         connectionID = request["id"]
@@ -57,8 +375,19 @@ class Redish():
         if "args" in request and len(request["args"]) != 0:
             return {"status": "ERROR",
                     "detail": "CONNECT has no arguments"}
-        newID = self.nextConnectionID
-        self.nextConnectionID += 1
+        if "id" in request:
+            # Asking for a particular id is how traces recreate connections
+            newID = request["id"]
+            if type(newID) not in (int, long) or newID < 1:
+                return {"status": "ERROR",
+                        "detail": "CONNECT id must be a positive integer"}
+            if newID in self.conectionIDs:
+                return {"status": "ERROR",
+                        "detail": "id %u already in use" % newID}
+            self.nextConnectionID = max(self.nextConnectionID, newID + 1)
+        else:
+            newID = self.nextConnectionID
+            self.nextConnectionID += 1
         self.conectionIDs.add(newID)
         return {"status": "OK", "id": newID}
 
@@ -67,6 +396,8 @@ class Redish():
             return {"status": "ERROR",
                     "detail": "DISCONNECT has no arguments"}
         self.conectionIDs.remove(request["id"])
+        self.evictionModeForConnectionID.pop(request["id"], None)
+        self.evictionSubscribers.discard(request["id"])
         return {"status": "OK"}
 
     def handleSET(self, request):
@@ -81,10 +412,9 @@ class Redish():
 
         key = request["args"][0]
         value = request["args"][1]
-        evicted = self._set(key, value, request)
+        evicted = self._set(key, value, request, self._collectEvictions(request))
         response = {"status": "OK"}
-        if evicted:
-            response["evicted"] = evicted
+        self._reportEvictions(request, response, evicted, len(evicted) // 2)
         return response
 
     def handleGET(self, request):
@@ -135,15 +465,21 @@ class Redish():
         if enqueue:
             return enqueue
 
+        # Only collect the evicted pairs if they're going to be sent anywhere
+        collect = self._collectEvictions(request)
         evicted = []
+        count = 0
         for i in range(0, argLen, 2):
             # Iterate through argument pairs
             key = request["args"][i]
             value = request["args"][i+1]
-            evicted.extend(self._set(key, value, request))
+            pair = self._set(key, value, request, collect)
+            if pair:
+                count += 1
+                if collect:
+                    evicted.extend(pair)
         response = {"status": "OK"}
-        if evicted:
-            response["evicted"] = evicted
+        self._reportEvictions(request, response, evicted, count)
         return response
 
     def handleINCRDECR(self, request):
@@ -163,11 +499,11 @@ class Redish():
         key = request["args"][0]
         if key not in self.database:
             # Key not present, so incr an implied 0. Same as setting incrementAmount directly
-            evicted = self._set(key, incrementAmount, request)
+            evicted = self._set(key, incrementAmount, request,
+                                self._collectEvictions(request))
             response = {"status": "OK", "result": incrementAmount}
             # New entry could evict an old one
-            if evicted:
-                response["evicted"] = evicted
+            self._reportEvictions(request, response, evicted, len(evicted) // 2)
             return response
 
         # Existing value that needs to be altered in place
@@ -215,7 +551,7 @@ class Redish():
             return {"status": "OK"}
 
         for command in transactionQueue:
-            results.append(self.processRequest(command))
+            results.append(self._dispatchRequest(command))
         del self.watchedKeysForConnectionID[connectionID]
         return {"status": "OK", "results": results}
 
@@ -247,15 +583,190 @@ class Redish():
         del self.watchedKeysForConnectionID[connectionID]
         return {"status": "OK"}
 
-    def processRequestJSON(self, jsonRequest):
+    def handleEVICTIONS(self, request):
+        if "args" not in request or len(request["args"]) != 1:
+            return {"status": "ERROR",
+                    "detail": "EVICTIONS requires one argument: mode"}
+        mode = request["args"][0]
+        if mode not in EVICTION_MODES:
+            return {"status": "ERROR",
+                    "detail": "EVICTIONS mode must be one of %s" % ", ".join(EVICTION_MODES)}
+        self.evictionModeForConnectionID[request["id"]] = mode
+        return {"status": "OK"}
+
+    def handleSUBSCRIBE(self, request):
+        if "args" in request and len(request["args"]) != 0:
+            return {"status": "ERROR",
+                    "detail": "SUBSCRIBE should have no arguments"}
+        self.evictionSubscribers.add(request["id"])
+        return {"status": "OK"}
+
+    def handleUNSUBSCRIBE(self, request):
+        if "args" in request and len(request["args"]) != 0:
+            return {"status": "ERROR",
+                    "detail": "UNSUBSCRIBE should have no arguments"}
+        self.evictionSubscribers.discard(request["id"])
+        return {"status": "OK"}
+
+    def _windowArgument(self, args, index, default):
+        # Returns the deadline for an optional window length in seconds,
+        # or False if it isn't valid
+        if len(args) <= index:
+            if default is None:
+                return None
+            return time.time() + default
+        seconds = args[index]
+        if type(seconds) not in (int, float) or seconds <= 0:
+            return False
+        return time.time() + seconds
+
+    def _stopProfiler(self):
+        profiler = self.profiler
+        self.profiler = None
+        profiler.stop()
+
+    def _stopTracer(self):
+        tracer = self.tracer
+        self.tracer = None
+        tracer.stop()
+
+    def handlePROFILE(self, request):
+        usage = {"status": "ERROR",
+                 "detail": "PROFILE requires arguments: START SAMPLE|CPROFILE file [seconds], or STOP"}
+        if "args" not in request or len(request["args"]) == 0:
+            return usage
+        args = request["args"]
+        if args == ["STOP"]:
+            if self.profiler is None:
+                return {"status": "ERROR",
+                        "detail": "PROFILE STOP called without PROFILE START"}
+            self._stopProfiler()
+            return {"status": "OK"}
+        if len(args) not in (3, 4) or args[0] != "START":
+            return usage
+        # Checked before use, so a bad request can't raise a TypeError
+        if not isinstance(args[1], basestring) or args[1] not in PROFILERS:
+            return usage
+        if not isinstance(args[2], basestring):
+            return usage
+        if self.profiler is not None and self.profiler.expired():
+            self._stopProfiler()
+        if self.profiler is not None:
+            return {"status": "ERROR",
+                    "detail": "PROFILE START called while already profiling"}
+        default = None
+        if args[1] == "CPROFILE":
+            default = CPROFILE_DEFAULT_SECONDS
+        deadline = self._windowArgument(args, 3, default)
+        if deadline is False:
+            return usage
         try:
-            request = json.loads(jsonRequest)
-        except ValueError:
-            return json.dumps(
-                    {"status": "ERROR", "detail": "could not parse json"})
-        return json.dumps(self.processRequest(request))
+            self.profiler = PROFILERS[args[1]](args[2], deadline)
+        except IOError as e:
+            return {"status": "ERROR",
+                    "detail": "could not open %s: %s" % (args[2], e.strerror)}
+        return {"status": "OK"}
+
+    def handleTRACE(self, request):
+        usage = {"status": "ERROR",
+                 "detail": "TRACE requires arguments: START file [seconds], or STOP"}
+        if "args" not in request or len(request["args"]) == 0:
+            return usage
+        args = request["args"]
+        if args == ["STOP"]:
+            if self.tracer is None:
+                return {"status": "ERROR",
+                        "detail": "TRACE STOP called without TRACE START"}
+            self._stopTracer()
+            return {"status": "OK"}
+        if len(args) not in (2, 3) or args[0] != "START":
+            return usage
+        if not isinstance(args[1], basestring):
+            return usage
+        if self.tracer is not None and self.tracer.expired():
+            self._stopTracer()
+        if self.tracer is not None:
+            return {"status": "ERROR",
+                    "detail": "TRACE START called while already tracing"}
+        deadline = self._windowArgument(args, 2, None)
+        if deadline is False:
+            return usage
+        # Recreate the open connections so their ids match on replay, and
+        # leave the next CONNECT with the same id it would get here. This
+        # costs one line per open connection, however many ids were used.
+        preamble = []
+        for connectionID in sorted(self.conectionIDs):
+            preamble.append({"command": "CONNECT", "id": connectionID})
+        lastID = self.nextConnectionID - 1
+        if lastID > 0 and lastID not in self.conectionIDs:
+            preamble.append({"command": "CONNECT", "id": lastID})
+            preamble.append({"command": "DISCONNECT", "id": lastID})
+        # Then the per connection state which changes their replies
+        for connectionID in sorted(self.conectionIDs):
+            if connectionID in self.evictionModeForConnectionID:
+                preamble.append({"command": "EVICTIONS", "id": connectionID,
+                                 "args": [self.evictionModeForConnectionID[connectionID]]})
+            if connectionID in self.evictionSubscribers:
+                preamble.append({"command": "SUBSCRIBE", "id": connectionID})
+            for key in self.watchedKeysForConnectionID.get(connectionID, ()):
+                preamble.append({"command": "WATCH", "id": connectionID,
+                                 "args": [key]})
+            if connectionID in self.transactionQueues:
+                preamble.append({"command": "MULTI", "id": connectionID})
+                preamble.extend(self.transactionQueues[connectionID])
+        try:
+            self.tracer = RequestTracer(args[1], deadline, preamble)
+        except IOError as e:
+            return {"status": "ERROR",
+                    "detail": "could not open %s: %s" % (args[1], e.strerror)}
+        return {"status": "OK"}
+
+    def _processInstrumented(self, request, func):
+        if not isinstance(request, dict):
+            return func(request)
+        command = request.get("command")
+        if command in ADMIN_COMMANDS:
+            return func(request)
+        if self.tracer is not None:
+            if self.tracer.expired():
+                self._stopTracer()
+            else:
+                self.tracer.record(request)
+        if self.profiler is not None:
+            if self.profiler.expired():
+                self._stopProfiler()
+            else:
+                if not isinstance(command, basestring):
+                    command = json.dumps(command)
+                return self.profiler.run(command, func, request)
+        return func(request)
+
+    def close(self):
+        # Makes sure profiles and traces still running get written out
+        if self.profiler is not None:
+            self._stopProfiler()
+        if self.tracer is not None:
+            self._stopTracer()
+        if self.arena is not None:
+            self.arena.close()
+
+    def _dispatchRequestJSON(self, request):
+        return json.dumps(self._dispatchRequest(request))
+
+    def processRequestJSON(self, jsonRequest):
+        ok, request = decodeRequestJSON(jsonRequest)
+        if not ok:
+            return json.dumps(request)
+        if self.profiler is None and self.tracer is None:
+            return self._dispatchRequestJSON(request)
+        return self._processInstrumented(request, self._dispatchRequestJSON)
 
     def processRequest(self, request):
+        if self.profiler is None and self.tracer is None:
+            return self._dispatchRequest(request)
+        return self._processInstrumented(request, self._dispatchRequest)
+
+    def _dispatchRequest(self, request):
         if "command" not in request:
             return {"status": "ERROR",
                     "detail": "'command' not present in request"}
@@ -295,18 +806,212 @@ class Redish():
             return self.handleWATCH(request)
         if command == "UNWATCH":
             return self.handleUNWATCH(request)
+        if command == "EVICTIONS":
+            return self.handleEVICTIONS(request)
+        if command == "SUBSCRIBE":
+            return self.handleSUBSCRIBE(request)
+        if command == "UNSUBSCRIBE":
+            return self.handleUNSUBSCRIBE(request)
+        if command == "PROFILE":
+            return self.handlePROFILE(request)
+        if command == "TRACE":
+            return self.handleTRACE(request)
 
         # Unhandled command
         return {"status": "ERROR",
                 "detail": "command '%s' not found" % command}
 
 
+# The codec functions are module level so they can run in pool workers
+
+def decodeRequestJSON(jsonRequest):
+    # Returns (True, request), or (False, errorResponse) for bad json
+    try:
+        return True, json.loads(jsonRequest)
+    except ValueError:
+        return False, {"status": "ERROR", "detail": "could not parse json"}
+
+def decodeRequestsJSON(jsonRequests):
+    return [decodeRequestJSON(jsonRequest) for jsonRequest in jsonRequests]
+
+def encodeResponsesJSON(responses):
+    return "".join(json.dumps(response) + "\n" for response in responses)
+
+class _PipelineThread(threading.Thread):
+    # Keeps the exception that killed the thread so it can be re-raised
+    # by the thread waiting on it
+    def __init__(self, target, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.target = target
+        self.args = args
+        self.error = None
+
+    def run(self):
+        try:
+            self.target(*self.args)
+        except Exception:
+            self.error = sys.exc_info()
+
+    def raiseError(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        raise RuntimeError("%s stopped unexpectedly" % self.name)
+
+def _put(queue, item, consumer):
+    # Like queue.put, but gives up if the consumer has died
+    while True:
+        try:
+            queue.put(item, True, 0.1)
+            return
+        except Queue.Full:
+            if not consumer.is_alive():
+                consumer.raiseError()
+
+def _get(queue, producer):
+    # Like queue.get, but gives up if the producer has died
+    while True:
+        try:
+            return queue.get(True, 0.1)
+        except Queue.Empty:
+            if not producer.is_alive():
+                try:
+                    return queue.get_nowait()
+                except Queue.Empty:
+                    producer.raiseError()
+
+def _putUnlessStopped(queue, item, stopped):
+    # Like queue.put, but returns False instead of waiting once stopped is set
+    while not stopped.is_set():
+        try:
+            queue.put(item, True, 0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+def _readLines(lines, lineQueue, stopped):
+    # Reads input on its own thread, so _readBatches can tell when it stalls
+    for line in itertools.chain(lines, [None]):
+        if not _putUnlessStopped(lineQueue, line, stopped):
+            return
+
+def _readBatches(lineQueue, lineReader, chunksize, pool, decoding, stopped):
+    # Hands batches of lines to the pool for decoding. decoding is bounded,
+    # so this waits rather than reading far ahead of the executor.
+    batch = []
+    def submit(batch):
+        if batch:
+            result = pool.apply_async(decodeRequestsJSON, (batch,))
+            if not _putUnlessStopped(decoding, result, stopped):
+                return None
+        return []
+    while batch is not None:
+        try:
+            line = lineQueue.get_nowait()
+        except Queue.Empty:
+            # Input has stalled, so don't hold back a partial batch
+            batch = submit(batch)
+            if batch is None:
+                return
+            line = _get(lineQueue, lineReader)
+        if line is None:
+            if submit(batch) is not None:
+                _putUnlessStopped(decoding, None, stopped)
+            return
+        batch.append(line)
+        if len(batch) >= chunksize:
+            batch = submit(batch)
+
+def _writeEncoded(pending, out):
+    # Writes encoded batches in the order they were submitted
+    while True:
+        result = pending.get()
+        if result is None:
+            return
+        out.write(result.get())
+        out.flush()
+
+def processRequestsJSONPipelined(instance, lines, out, workers, chunksize):
+    # Worker processes decode requests and encode responses, while this
+    # thread alone applies requests to instance, in arrival order
+    pool = multiprocessing.Pool(workers)
+    # Batches waiting on each side of the executor are bounded, so a slow
+    # executor or a slow reader of out holds back reading more input
+    decoding = Queue.Queue(workers * 4)
+    pending = Queue.Queue(workers * 4)
+    stopped = threading.Event()
+    lineQueue = Queue.Queue(workers * 4 * chunksize)
+    lineReader = _PipelineThread(_readLines, lines, lineQueue, stopped)
+    reader = _PipelineThread(_readBatches, lineQueue, lineReader, chunksize,
+                             pool, decoding, stopped)
+    writer = _PipelineThread(_writeEncoded, pending, out)
+    lineReader.start()
+    reader.start()
+    writer.start()
+    batch = []
+    def flush(batch):
+        if batch:
+            _put(pending, pool.apply_async(encodeResponsesJSON, (batch,)), writer)
+        return []
+    finished = False
+    try:
+        while True:
+            try:
+                decoded = decoding.get_nowait()
+            except Queue.Empty:
+                # Input has stalled, so send out what we have before waiting
+                batch = flush(batch)
+                decoded = _get(decoding, reader)
+            if decoded is None:
+                break
+            for ok, request in decoded.get():
+                if ok:
+                    batch.append(instance.processRequest(request))
+                else:
+                    batch.append(request)
+                batch.extend(instance.drainNotifications())
+            if len(batch) >= chunksize:
+                batch = flush(batch)
+        flush(batch)
+        _put(pending, None, writer)
+        writer.join()
+        if writer.error is not None:
+            writer.raiseError()
+        finished = True
+    finally:
+        stopped.set()
+        if finished:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("maxKeys")
+    parser.add_argument("maxKeys", type=int)
+    parser.add_argument("--arena",
+            help="file to memory map for storing large string values")
+    parser.add_argument("--arena-threshold", type=int, default=4096,
+            help="string values longer than this are stored in the arena")
+    parser.add_argument("--codec-workers", type=int, default=0,
+            help="processes to use for json decoding and encoding")
+    parser.add_argument("--codec-chunksize", type=int, default=64,
+            help="requests handed to a codec worker at a time")
     args = parser.parse_args()
-    instance = Redish(args.maxKeys)
-    line = sys.stdin.readline()
-    while line != '':
-        print instance.processRequestJSON(line)
+    arena = None
+    if args.arena:
+        arena = ValueArena(args.arena, args.arena_threshold)
+    instance = Redish(args.maxKeys, arena)
+    if args.codec_workers > 0:
+        processRequestsJSONPipelined(
+                instance, iter(sys.stdin.readline, ''), sys.stdout,
+                args.codec_workers, args.codec_chunksize)
+    else:
         line = sys.stdin.readline()
+        while line != '':
+            print instance.processRequestJSON(line)
+            for notification in instance.drainNotifications():
+                print json.dumps(notification)
+            line = sys.stdin.readline()
+    instance.close()
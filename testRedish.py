@@ -1,6 +1,14 @@
 import redish
 import unittest
 import json
+import os
+import tempfile
+import StringIO
+import time
+import subprocess
+import sys
+import threading
+import Queue
 
 class TestRedish(unittest.TestCase):
     def init(self, instance):
@@ -142,6 +150,94 @@ class TestRedish(unittest.TestCase):
                 {"status": "OK", "result": 1, "evicted": ["reg", 4]})
         process("DECR", ["evennewerkey"],
                 {"status": "OK", "result": -1, "evicted": ["newnew", "whatever"]})
+
+    def testEvictionModes(self):
+        instance = redish.Redish(2)
+        process = self.init(instance)
+        process("EVICTIONS", None,
+                {"status": "ERROR",
+                 "detail": "EVICTIONS requires one argument: mode"})
+        process("EVICTIONS", ["LOUD"],
+                {"status": "ERROR",
+                 "detail": "EVICTIONS mode must be one of INLINE, COUNT, NONE"})
+        process("MSET", ["key1", "one", "key2", "two"],
+                {"status": "OK"})
+
+        process("EVICTIONS", ["COUNT"], {"status": "OK"})
+        process("MSET", ["key3", "three", "key4", "four", "key5", "five"],
+                {"status": "OK", "evictedCount": 3})
+        process("INCR", ["key6"],
+                {"status": "OK", "result": 1, "evictedCount": 1})
+
+        process("EVICTIONS", ["NONE"], {"status": "OK"})
+        process("SET", ["key7", "seven"], {"status": "OK"})
+        self.assertEqual(instance.drainNotifications(), [])
+
+        process("EVICTIONS", ["INLINE"], {"status": "OK"})
+        process("SET", ["key8", "eight"],
+                {"status": "OK", "evicted": ["key6", 1]})
+
+        # Modes are per connection
+        process2 = self.init(instance)
+        process("EVICTIONS", ["NONE"], {"status": "OK"})
+        process2("SET", ["key9", "nine"],
+                 {"status": "OK", "evicted": ["key7", "seven"]})
+
+    def testEvictionSubscribers(self):
+        instance = redish.Redish(2)
+        loader = self.init(instance)
+        subscriber = self.init(instance)
+        self.init(instance)
+        loader("EVICTIONS", ["NONE"], {"status": "OK"})
+        subscriber("SUBSCRIBE", ["extra"],
+                   {"status": "ERROR",
+                    "detail": "SUBSCRIBE should have no arguments"})
+        subscriber("SUBSCRIBE", None, {"status": "OK"})
+        instance.processRequest({"command": "SUBSCRIBE", "id": 3})
+
+        # Subscribers get evictions even though the writer's reply doesn't
+        instance.notificationBatchSize = 2
+        loader("MSET", ["key1", "one", "key2", "two", "key3", "three",
+                        "key4", "four", "key5", "five"],
+               {"status": "OK"})
+        self.assertEqual(
+                instance.drainNotifications(),
+                [{"notification": "EVICTED", "id": 2,
+                  "evicted": ["key1", "one", "key2", "two"]},
+                 {"notification": "EVICTED", "id": 2,
+                  "evicted": ["key3", "three"]},
+                 {"notification": "EVICTED", "id": 3,
+                  "evicted": ["key1", "one", "key2", "two"]},
+                 {"notification": "EVICTED", "id": 3,
+                  "evicted": ["key3", "three"]}])
+        self.assertEqual(instance.drainNotifications(), [])
+
+        subscriber("UNSUBSCRIBE", None, {"status": "OK"})
+        instance.processRequest({"command": "DISCONNECT", "id": 3})
+        loader("SET", ["key6", "six"], {"status": "OK"})
+        self.assertEqual(instance.drainNotifications(), [])
+
+    def testCommandLine(self):
+        requests = ['{"command": "CONNECT"}',
+                    '{"id": 1, "command": "SUBSCRIBE"}',
+                    '{"id": 1, "command": "MSET", "args": ["a", 1, "b", 2, "c", 3]}',
+                    '{"id": 1, "command": "EVICTIONS", "args": ["COUNT"]}',
+                    '{"id": 1, "command": "MSET", "args": ["d", 4]}']
+        proc = subprocess.Popen(
+                [sys.executable, redish.__file__.replace(".pyc", ".py"), "1"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        stdout, stderr = proc.communicate("\n".join(requests) + "\n")
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual(
+                [json.loads(line) for line in stdout.splitlines()],
+                [{"status": "OK", "id": 1},
+                 {"status": "OK"},
+                 {"status": "OK", "evicted": ["a", 1, "b", 2]},
+                 {"notification": "EVICTED", "id": 1, "evicted": ["a", 1, "b", 2]},
+                 {"status": "OK"},
+                 {"status": "OK", "evictedCount": 1},
+                 {"notification": "EVICTED", "id": 1, "evicted": ["c", 3]}])
+
     def testINCR(self):
         process = self.init(redish.Redish(10))
         process("SET", ["key1", 1],
@@ -347,12 +443,377 @@ class TestRedish(unittest.TestCase):
         process1("EXEC", None, {"status": "OK", "results": [{"status": "OK"}]})
         process1("GET", ["foo"], {"status": "OK", "result": 3})
 
+    def makeArena(self, threshold, initialSize=16):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        arena = redish.ValueArena(path, threshold, initialSize)
+        def cleanup():
+            arena.close()
+            os.remove(path)
+        self.addCleanup(cleanup)
+        return arena
+
+    def testValueArena(self):
+        arena = self.makeArena(0)
+        a = arena.store("a" * 10)
+        b = arena.store(u"b\u00e9" * 5)
+        c = arena.store("c" * 10)
+        self.assertEqual(arena.load(a), "a" * 10)
+        self.assertEqual(arena.load(b), u"b\u00e9" * 5)
+        self.assertEqual(arena.load(c), "c" * 10)
+        # Grew past the initial size
+        self.assertEqual(arena.end, 35)
+        self.assertTrue(arena.size >= arena.end)
+
+        # Freed neighbors are coalesced into one block
+        arena.free(a)
+        arena.free(b)
+        self.assertEqual(zip(arena.freeOffsets, arena.freeLengths), [(0, 25)])
+        d = arena.store("d" * 20)
+        self.assertEqual(d.offset, 0)
+        self.assertEqual(zip(arena.freeOffsets, arena.freeLengths), [(20, 5)])
+
+        # Freeing at the end gives the space back entirely
+        arena.free(c)
+        self.assertEqual(arena.end, 20)
+        self.assertEqual(arena.freeOffsets, [])
+        arena.free(d)
+        self.assertEqual(arena.end, 0)
+
+    def testArenaValues(self):
+        arena = self.makeArena(5)
+        process = self.init(redish.Redish(2, arena))
+        process("SET", ["small", "tiny"], {"status": "OK"})
+        process("SET", ["big", "large value"], {"status": "OK"})
+        self.assertEqual(arena.end, len("large value"))
+        process("GET", ["small"], {"status": "OK", "result": "tiny"})
+        process("GET", ["big"], {"status": "OK", "result": "large value"})
+        process("MGET", ["big", "small"],
+                {"status": "OK", "result": ["large value", "tiny"]})
+        process("INCR", ["big"],
+                {"status": "ERROR",
+                 "detail": "INCR works only on 64 bit signed integers"})
+
+        # Overwriting frees the old space
+        process("SET", ["big", "other value"], {"status": "OK"})
+        self.assertEqual(arena.end, len("other value"))
+        process("SET", ["big", 1], {"status": "OK"})
+        self.assertEqual(arena.end, 0)
+
+        # Evicted values are still reported
+        process("SET", ["big", "large value"], {"status": "OK"})
+        process("MSET", ["new1", "x", "new2", "y"],
+                {"status": "OK",
+                 "evicted": ["small", "tiny", "big", "large value"]})
+        self.assertEqual(arena.end, 0)
+
+        # Values which won't be reported aren't read back from the arena
+        loads = []
+        def load(ref):
+            loads.append(ref)
+            return redish.ValueArena.load(arena, ref)
+        arena.load = load
+        process("EVICTIONS", ["COUNT"], {"status": "OK"})
+        process("MSET", ["big1", "large value", "big2", "large value"],
+                {"status": "OK", "evictedCount": 2})
+        process("SET", ["big3", "large value"],
+                {"status": "OK", "evictedCount": 1})
+        self.assertEqual(loads, [])
+        # big1 was freed after big3 was stored after big2
+        self.assertEqual(arena.end, 3 * len("large value"))
+        self.assertEqual(zip(arena.freeOffsets, arena.freeLengths),
+                         [(0, len("large value"))])
+
+    def testPipelinedMatchesSerial(self):
+        lines = ['{"command": "CONNECT"}\n',
+                 '{"command": "CONNECT"}\n',
+                 'not json\n',
+                 '{"id": 2, "command": "SUBSCRIBE"}\n',
+                 '{"id": 1, "command": "EVICTIONS", "args": ["COUNT"]}\n']
+        for i in range(50):
+            lines.append('{"id": 1, "command": "SET", "args": ["k%u", %u]}\n' % (i, i))
+            lines.append('{"id": 2, "command": "INCR", "args": ["k%u"]}\n' % (i - 1))
+        lines += ['{"id": 1, "command": "WATCH", "args": ["k49"]}\n',
+                  '{"id": 1, "command": "MULTI"}\n',
+                  '{"id": 1, "command": "MGET", "args": ["k48", "k49"]}\n',
+                  '{"id": 2, "command": "MSET", "args": ["a", 1, "b", 2]}\n',
+                  '{"id": 1, "command": "EXEC"}\n',
+                  '{"id": 2, "command": "DISCONNECT"}\n']
+
+        serial = redish.Redish(8)
+        expected = ""
+        for line in lines:
+            expected += serial.processRequestJSON(line) + "\n"
+            for notification in serial.drainNotifications():
+                expected += json.dumps(notification) + "\n"
+
+        for workers, chunksize in [(1, 1), (3, 7)]:
+            out = StringIO.StringIO()
+            redish.processRequestsJSONPipelined(
+                    redish.Redish(8), iter(lines), out, workers, chunksize)
+            self.assertEqual(out.getvalue(), expected)
+
+    def testPipelinedWriterFailure(self):
+        class BrokenPipe():
+            def write(self, data):
+                raise IOError(32, "Broken pipe")
+            def flush(self):
+                pass
+        lines = ['{"command": "CONNECT"}\n'] * 5000
+        with self.assertRaises(IOError):
+            redish.processRequestsJSONPipelined(
+                    redish.Redish(8), iter(lines), BrokenPipe(), 2, 4)
+
+    def testPipelinedBackpressure(self):
+        consumed = [0]
+        def lines():
+            for i in range(1000):
+                consumed[0] += 1
+                yield '{"command": "CONNECT"}\n'
+        instance = redish.Redish(8)
+        processRequest = instance.processRequest
+        readAhead = []
+        def slowProcessRequest(request):
+            if not readAhead:
+                # Give the reader time to run ahead as far as it can
+                time.sleep(0.5)
+                readAhead.append(consumed[0])
+            return processRequest(request)
+        instance.processRequest = slowProcessRequest
+        out = StringIO.StringIO()
+        redish.processRequestsJSONPipelined(instance, lines(), out, 1, 1)
+        self.assertEqual(len(out.getvalue().splitlines()), 1000)
+        self.assertTrue(readAhead[0] < 20)
+
+    def testPipelinedInteractive(self):
+        # A client waiting on each reply before sending more must get it,
+        # even though the batch it's in never fills up
+        requests = Queue.Queue()
+        replies = Queue.Queue()
+        class Replies():
+            def write(self, data):
+                replies.put(data)
+            def flush(self):
+                pass
+        pipeline = threading.Thread(
+                target=redish.processRequestsJSONPipelined,
+                args=(redish.Redish(8), iter(requests.get, None), Replies(), 2, 64))
+        pipeline.start()
+        try:
+            requests.put('{"command": "CONNECT"}\n')
+            self.assertEqual(replies.get(True, 5), '{"status": "OK", "id": 1}\n')
+            requests.put('{"id": 1, "command": "GET", "args": ["key"]}\n')
+            self.assertEqual(replies.get(True, 5), '{"status": "OK", "result": ""}\n')
+        finally:
+            requests.put(None)
+            pipeline.join(5)
+        self.assertFalse(pipeline.is_alive())
+
+    def makePath(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def testProfileBadArgs(self):
+        process = self.init(redish.Redish(10))
+        usage = {"status": "ERROR",
+                 "detail": "PROFILE requires arguments: START SAMPLE|CPROFILE file [seconds], or STOP"}
+        process("PROFILE", None, usage)
+        process("PROFILE", ["START"], usage)
+        process("PROFILE", ["START", "FAST", "out"], usage)
+        process("PROFILE", ["START", "SAMPLE", "out", 0], usage)
+        process("PROFILE", ["START", "SAMPLE", 5], usage)
+        process("PROFILE", ["START", "SAMPLE", None], usage)
+        process("PROFILE", ["START", ["SAMPLE"], "out"], usage)
+        process("PROFILE", ["STOP"],
+                {"status": "ERROR",
+                 "detail": "PROFILE STOP called without PROFILE START"})
+        process("PROFILE", ["START", "SAMPLE", "/nonexistent/out"],
+                {"status": "ERROR",
+                 "detail": "could not open /nonexistent/out: No such file or directory"})
+        path = self.makePath()
+        process("PROFILE", ["START", "SAMPLE", path], {"status": "OK"})
+        process("PROFILE", ["START", "CPROFILE", path],
+                {"status": "ERROR",
+                 "detail": "PROFILE START called while already profiling"})
+        process("PROFILE", ["STOP"], {"status": "OK"})
+
+    def testDeterministicProfile(self):
+        instance = redish.Redish(10)
+        process = self.init(instance)
+        path = self.makePath()
+        process("PROFILE", ["START", "CPROFILE", path], {"status": "OK"})
+        process("SET", ["key", "value"], {"status": "OK"})
+        process("GET", ["key"], {"status": "OK", "result": "value"})
+        process("PROFILE", ["STOP"], {"status": "OK"})
+        with open(path) as f:
+            report = json.load(f)
+        self.assertEqual(report["mode"], "CPROFILE")
+        self.assertEqual(sorted(report["commands"]), ["GET", "SET"])
+        setFunctions = report["commands"]["SET"]["functions"]
+        self.assertEqual(setFunctions["handleSET"]["calls"], 1)
+        self.assertTrue("json.dumps" in setFunctions)
+        self.assertTrue("_get" in report["commands"]["GET"]["functions"])
+
+        # The window ends at the first request after it runs out
+        process("PROFILE", ["START", "CPROFILE", path, 60], {"status": "OK"})
+        instance.profiler.deadline = time.time() - 1
+        process("GET", ["key"], {"status": "OK", "result": "value"})
+        self.assertEqual(instance.profiler, None)
+        with open(path) as f:
+            self.assertEqual(json.load(f)["commands"], {})
+
+    def testSamplingProfile(self):
+        instance = redish.Redish(10)
+        process = self.init(instance)
+        path = self.makePath()
+        process("PROFILE", ["START", "SAMPLE", path], {"status": "OK"})
+        giveUp = time.time() + 5
+        while instance.profiler.samples["MSET"] == 0 and time.time() < giveUp:
+            instance.processRequest(
+                    {"id": 1, "command": "MSET", "args": ["key", "value"] * 1000})
+        process("PROFILE", ["STOP"], {"status": "OK"})
+        with open(path) as f:
+            report = json.load(f)
+        self.assertEqual(report["mode"], "SAMPLE")
+        mset = report["commands"]["MSET"]
+        self.assertTrue(mset["samples"] > 0)
+        self.assertEqual(mset["functions"]["handleMSET"], mset["samples"])
+        self.assertTrue("PROFILE" not in report["commands"])
+
+        # The sampler writes the report itself when the window closes
+        process("PROFILE", ["START", "SAMPLE", path, 0.05], {"status": "OK"})
+        instance.profiler.thread.join(5)
+        self.assertFalse(instance.profiler.thread.is_alive())
+        with open(path) as f:
+            self.assertEqual(json.load(f)["commands"], {})
+        process("PROFILE", ["START", "SAMPLE", path], {"status": "OK"})
+        process("PROFILE", ["STOP"], {"status": "OK"})
+
+    def testTrace(self):
+        instance = redish.Redish(10)
+        self.init(instance)
+        process = self.init(instance)
+        self.init(instance)
+        instance.processRequest({"command": "DISCONNECT", "id": 1})
+        path = self.makePath()
+        process("TRACE", None,
+                {"status": "ERROR",
+                 "detail": "TRACE requires arguments: START file [seconds], or STOP"})
+        process("TRACE", ["START", None],
+                {"status": "ERROR",
+                 "detail": "TRACE requires arguments: START file [seconds], or STOP"})
+        process("TRACE", ["START", 5, 10],
+                {"status": "ERROR",
+                 "detail": "TRACE requires arguments: START file [seconds], or STOP"})
+        process("TRACE", ["STOP"],
+                {"status": "ERROR",
+                 "detail": "TRACE STOP called without TRACE START"})
+        process("TRACE", ["START", path], {"status": "OK"})
+        process("TRACE", ["START", path],
+                {"status": "ERROR",
+                 "detail": "TRACE START called while already tracing"})
+        process("SET", ["key", 1], {"status": "OK"})
+        process("INCR", ["key"], {"status": "OK", "result": 2})
+        process("TRACE", ["STOP"], {"status": "OK"})
+        process("INCR", ["key"], {"status": "OK", "result": 3})
+
+        # Replaying gets the same connection ids, and so the same results
+        replay = redish.Redish(10)
+        with open(path) as f:
+            responses = [json.loads(replay.processRequestJSON(line)) for line in f]
+        self.assertEqual(responses,
+                         [{"status": "OK", "id": 2},
+                          {"status": "OK", "id": 3},
+                          {"status": "OK"},
+                          {"status": "OK", "result": 2}])
+        self.assertEqual(replay.processRequest({"command": "CONNECT"}),
+                         {"status": "OK", "id": 4})
+
+        # The next id is kept even when the last one handed out is closed
+        instance.processRequest({"command": "CONNECT"})
+        instance.processRequest({"command": "DISCONNECT", "id": 4})
+        process("TRACE", ["START", path], {"status": "OK"})
+        process("TRACE", ["STOP"], {"status": "OK"})
+        replay = redish.Redish(10)
+        with open(path) as f:
+            for line in f:
+                replay.processRequestJSON(line)
+        self.assertEqual(replay.conectionIDs, set([2, 3]))
+        self.assertEqual(replay.processRequest({"command": "CONNECT"}),
+                         {"status": "OK", "id": 5})
+
+    def testTraceWindow(self):
+        instance = redish.Redish(10)
+        process = self.init(instance)
+        path = self.makePath()
+        process("TRACE", ["START", path, 0.05], {"status": "OK"})
+        process("SET", ["key", 1], {"status": "OK"})
+        # The file is complete once the window closes, without another request
+        instance.tracer.timer.join(5)
+        with open(path) as f:
+            self.assertEqual([json.loads(line) for line in f],
+                             [{"command": "CONNECT", "id": 1},
+                              {"command": "SET", "id": 1, "args": ["key", 1]}])
+        process("GET", ["key"], {"status": "OK", "result": 1})
+        self.assertEqual(instance.tracer, None)
+        process("TRACE", ["START", path, 60], {"status": "OK"})
+        process("TRACE", ["STOP"], {"status": "OK"})
+
+    def testTraceConnectionState(self):
+        instance = redish.Redish(1)
+        process = self.init(instance)
+        other = self.init(instance)
+        process("EVICTIONS", ["COUNT"], {"status": "OK"})
+        process("SUBSCRIBE", None, {"status": "OK"})
+        other("WATCH", ["key"], {"status": "OK"})
+        other("MULTI", None, {"status": "OK"})
+        other("SET", ["key", "value"], {"status": "QUEUED"})
+        path = self.makePath()
+        process("TRACE", ["START", path], {"status": "OK"})
+        traced = [{"command": "SET", "id": 1, "args": ["key", 1]},
+                  {"command": "SET", "id": 1, "args": ["other", 2]},
+                  {"command": "EXEC", "id": 2}]
+        expected = [instance.processRequest(request) for request in traced]
+        notifications = instance.drainNotifications()
+        process("TRACE", ["STOP"], {"status": "OK"})
+        self.assertEqual(expected[1], {"status": "OK", "evictedCount": 1})
+        self.assertEqual(expected[2],
+                         {"status": "OK",
+                          "results": [{"status": "OK", "evicted": ["other", 2]}]})
+
+        # Replaying gives the same replies and notifications
+        replay = redish.Redish(1)
+        with open(path) as f:
+            responses = [json.loads(replay.processRequestJSON(line)) for line in f]
+        self.assertEqual(responses[-3:], expected)
+        self.assertEqual(replay.drainNotifications()[-len(notifications):],
+                         notifications)
+
     def testBadInput(self):
         instance = redish.Redish(1)
         self.assertEqual(
                 instance.processRequest(
                     {"command": "CONNECT", "args": ["bad arg"]}),
                 {"status": "ERROR", "detail": "CONNECT has no arguments"})
+        self.assertEqual(
+                instance.processRequest({"command": "CONNECT", "id": 0}),
+                {"status": "ERROR",
+                 "detail": "CONNECT id must be a positive integer"})
+        self.assertEqual(
+                instance.processRequest({"command": "CONNECT", "id": "5"}),
+                {"status": "ERROR",
+                 "detail": "CONNECT id must be a positive integer"})
+        self.assertEqual(
+                instance.processRequest({"command": "CONNECT", "id": 5}),
+                {"status": "OK", "id": 5})
+        self.assertEqual(
+                instance.processRequest({"command": "CONNECT", "id": 5}),
+                {"status": "ERROR", "detail": "id 5 already in use"})
+        self.assertEqual(
+                instance.processRequest({"command": "CONNECT"}),
+                {"status": "OK", "id": 6})
         self.assertEqual(
                 instance.processRequest({"command": "INCR", "args": ["key"]}),
                 {"status": "ERROR",